@@ -2,8 +2,24 @@
 # Author: F. Anders (AIP)
 # Last modified: 17.04.2018
 
+import functools
 import numpy as np
 
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+try:
+    import joblib
+except ImportError:
+    joblib = None
+
 # Isotropic Priors (Table 1 in Astraatmadja&Bailer-Jones 2016)
 def uniform_distance_prior(d, rlim=30.):
     """
@@ -16,7 +32,8 @@ def uniform_distance_prior(d, rlim=30.):
     Output:
         Uniform distance prior
     """
-    return np.piecewise(d, [d < 0, (d >= 0)*(d<=rlim), d>rlim], [0, 1/rlim, 0])
+    d = np.asarray(d, dtype=float)
+    return ((d >= 0) & (d <= rlim)) * (1. / rlim)
 
 def uniform_density_prior(d, rlim=30.):
     """
@@ -29,7 +46,10 @@ def uniform_density_prior(d, rlim=30.):
     Output:
         Uniform density prior
     """
-    return np.piecewise(d, [d < 0, (d >= 0)*(d<=rlim), d>rlim], [0, 1/(rlim**3.) * d**2., 0])
+    d    = np.asarray(d, dtype=float)
+    out  = 1. / rlim**3. * d * d
+    out *= (d >= 0) & (d <= rlim)
+    return out
 
 def exp_prior(d, L=1.35):
     """
@@ -42,10 +62,108 @@ def exp_prior(d, L=1.35):
     Output:
         Exponentially decreasing space density prior
     """
-    return np.piecewise(d, [d < 0, d >= 0], [0, 1/(2*L**3.) * d**2. * np.exp(- d / L )])
+    d     = np.asarray(d, dtype=float)
+    inv_L = 1. / L
+    out   = 0.5 * inv_L**3. * d * d * np.exp(- d * inv_L)
+    out  *= (d >= 0)
+    return out
+
+# Available priors, by prior keyword
+PRIORS = {"exponential":      exp_prior,
+          "uniform_density":  uniform_density_prior,
+          "uniform_distance": uniform_distance_prior}
+
+def _prior_function(prior):
+    """
+    Returns the prior function corresponding to the prior keyword
+    """
+    try:
+        return PRIORS[prior]
+    except KeyError:
+        raise ValueError("Prior keyword does not exist")
+
+def _as_dtype(x, dtype):
+    """
+    Casts a scalar or array to the given floating point type, keeping scalars scalar
+    """
+    dtype = np.dtype(dtype).type
+    return dtype(x) if np.isscalar(x) else np.asarray(x, dtype=dtype)
+
+@functools.lru_cache(maxsize=8)
+def _grid_and_prior(min_dist, max_dist, resolution, prior, dtype=np.float64):
+    """
+    Distance grid, its inverse and the prior evaluated on it, cached (as 
+    read-only arrays) so that repeated calls with the same grid do not recompute them
+    """
+    distarray = np.linspace(min_dist, max_dist, resolution)
+    prior_d   = _prior_function(prior)(distarray).astype(dtype)
+    distarray = distarray.astype(dtype)
+    with np.errstate(divide="ignore"):
+        inv_d = np.reciprocal(distarray)
+    for array in (distarray, inv_d, prior_d):
+        array.setflags(write=False)
+    return distarray, inv_d, prior_d
+
+def fast_exp_neg(x, out=None):
+    """
+    Fast approximation of exp(-x) for x >= 0
+    
+    For moderate x this is about on par with numpy's vectorised np.exp; the gain 
+    (several times faster) is for large x deep in the underflow range, which is 
+    where most of a posterior grid lies.
+    
+    Input:
+        x:   argument (array or scalar)
+    Optional:
+        out: array of the shape of x into which the result is written (may be x itself)
+    Output:
+        exp(-x), to a relative accuracy of ~2e-7 (exact np.exp if numba is not installed)
+    """
+    if nb is None:
+        if out is None:
+            return np.exp(-np.asarray(x))
+        np.negative(x, out=out)
+        return np.exp(out, out=out)
+    x = np.asarray(x)
+    if x.dtype.kind != "f":
+        x = x.astype(np.float64)
+    res = np.empty(x.shape) if out is None else out
+    # The kernel works on 2D arrays of any strides, so that column blocks of a 
+    # larger array are processed in place without copies
+    if x.ndim <= 2:
+        _fast_exp_neg(np.atleast_2d(x), np.atleast_2d(res))
+    else:
+        _fast_exp_neg(x.reshape(-1, x.shape[-1]), res.reshape(-1, x.shape[-1]))
+    return res[()] if out is None else out
+
+if nb is not None:
+    # No 'nnan'/'ninf' in fastmath: NaN input has to stay NaN, and overflow gives inf
+    @nb.njit(fastmath={'contract', 'arcp', 'nsz', 'afn'}, nogil=True, cache=True)
+    def _fast_exp_neg(x, out):
+        # exp(-x) = 2**k * 2**f with k = round(-x/ln2): 2**f from a polynomial 
+        # on [-0.5, 0.5], 2**k added directly to the exponent bits of the result
+        tmp  = np.empty(1)
+        bits = tmp.view(np.int64)
+        for i in range(x.shape[0]):
+            for j in range(x.shape[1]):
+                xi = np.float64(x[i, j])
+                t  = max(-xi * 1.4426950408889634, -1022.)
+                k  = np.floor(t + 0.5)
+                f  = t - k
+                p  = 1. + f*(0.6931471805599453 + f*(0.2402265069591007 + f*(0.05550410866482158 
+                        + f*(0.009618129107628477 + f*(0.0013333558146428443 + f*0.00015403530393381608)))))
+                if xi != xi:
+                    p, k = xi, 0.
+                elif t <= -1022.:
+                    p, k = 0., 0.
+                elif t >= 1024.:
+                    p, k = np.inf, 0.
+                tmp[0]     = p
+                bits[0]   += np.int64(k) << 52
+                out[i, j]  = tmp[0]
 
 # Likelihood
-def likelihood(pi, d, sigma_pi):
+def likelihood(pi, d, sigma_pi, fast_exp=False, out=None, inv_d=None):
     """
     Gaussian likelihood of parallax given distance and parallax uncertainty
         
@@ -53,15 +171,50 @@ def likelihood(pi, d, sigma_pi):
         pi:       parallax (array or scalar)
         d:        distance (typically an array)
         sigma_pi: parallax_uncertainty (array or scalar)
+    Optional:
+        fast_exp: use the fast approximate exponential fast_exp_neg (default: False)
+        out:      preallocated array into which the result is written
+        inv_d:    precomputed 1/d (saves recomputing it when d is reused)
     Output:
         Likelihood of parallax given distance and parallax uncertainty (formula 1 of Astraatmadja&Bailer-Jones 2016)
     """
-    if np.isscalar(pi):
-        return 1/np.sqrt(2*np.pi*sigma_pi**2.) * np.exp(-1/(2*sigma_pi**2.) * (pi - 1./d)**2. )
+    out  = _likelihood_unnormalized(pi, d, sigma_pi, fast_exp=fast_exp, out=out, inv_d=inv_d)
+    out *= 1/np.sqrt(2*np.pi*sigma_pi**2.)
+    return out
+
+def _likelihood_unnormalized(pi, d, sigma_pi, fast_exp=False, out=None, inv_d=None):
+    """
+    Likelihood without the 1/sqrt(2 pi sigma_pi^2) prefactor, for use where 
+    the result is normalised afterwards anyway
+    """
+    # Always computed on a 2D (distance, star) grid; reshaped to the input shapes at the end
+    shape = np.shape(d) + np.shape(pi)
+    if inv_d is None:
+        d = np.atleast_1d(d)
+        if d.dtype.kind != "f":
+            d = d.astype(float)
+        inv_d = np.reciprocal(d)
+    inv_d = np.atleast_1d(inv_d)[:, np.newaxis]
+    pi    = np.atleast_1d(pi)[np.newaxis, :]
+    if out is None:
+        buf = np.empty(np.broadcast(pi, inv_d, sigma_pi).shape, 
+                       dtype=np.result_type(pi, inv_d, sigma_pi))
+    else:
+        buf       = out.view()
+        buf.shape = (inv_d.shape[0], pi.shape[1])
+    # All steps in place, so that no further temporaries of the output size are created
+    np.subtract(pi, inv_d, out=buf)
+    np.square(buf, out=buf)
+    if fast_exp:
+        buf *= 1/(2*sigma_pi**2.)
+        fast_exp_neg(buf, out=buf)
     else:
-        return 1/np.sqrt(2*np.pi*sigma_pi**2.) * np.exp(-1/(2*sigma_pi**2.) * (pi[np.newaxis, :] - 1./d[:, np.newaxis])**2. )
+        buf *= -1/(2*sigma_pi**2.)
+        np.exp(buf, out=buf)
+    return out if out is not None else buf.reshape(shape)[()]
 
-def posterior(distarray, pi, sigma_pi, prior="exponential" ):
+def posterior(distarray, pi, sigma_pi, prior="exponential", chunk_size=None, fast_exp=False, prior_d=None,
+              dtype=np.float64, n_jobs=None, inv_d=None):
     """
     Posterior distance distribution.
         
@@ -71,28 +224,358 @@ def posterior(distarray, pi, sigma_pi, prior="exponential" ):
         sigma_pi: parallax_uncertainty (array or scalar)
     Optional:
         prior:    String. Decides which prior to use (at present either "exponential", "uniform_density", "uniform_distance")
+        chunk_size: If given, the PDF is evaluated for chunk_size stars at a time, directly 
+                  into the output array. This avoids full-size temporaries for large catalogues.
+        fast_exp: use the fast approximate exponential fast_exp_neg (default: False)
+        prior_d:  prior already evaluated on distarray (overrides prior)
+        dtype:    floating point type in which the PDF is computed (default: np.float64; 
+                  np.float32 halves the memory traffic at reduced precision)
+        n_jobs:   number of threads over which the chunks of stars are distributed 
+                  (requires joblib; -1 uses all cores; default: serial evaluation)
+        inv_d:    precomputed 1/distarray
     Output:
-        Posterior distance PDF (up to a factor), given parallax and parallax uncertainty (formula 2 of Astraatmadja&Bailer-Jones 2016)
-    """
-    if prior == "exponential":
-        prior = exp_prior
-    elif prior == "uniform_density":
-        prior = uniform_density_prior
-    elif prior == "uniform_distance":
-        prior = uniform_distance_prior
+        Posterior distance PDF (up to a factor for each star), given parallax and parallax uncertainty (formula 2 of Astraatmadja&Bailer-Jones 2016)
+    """
+    if prior_d is None:
+        prior_d = _prior_function(prior)(distarray)
+    if inv_d is None:
+        inv_d = np.reciprocal(np.asarray(distarray, dtype=dtype))
+    distarray, prior_d = _as_dtype(distarray, dtype), _as_dtype(prior_d, dtype)
+    inv_d              = _as_dtype(inv_d, dtype)
+    pi, sigma_pi       = _as_dtype(pi, dtype), _as_dtype(sigma_pi, dtype)
+
+    # Single code path for scalar and array input: 2D (distance, star) internally,
+    # squeezed back to 1D for scalar pi
+    shape = np.shape(distarray) + np.shape(pi)
+    pi    = np.atleast_1d(pi)
+
+    if n_jobs is not None and joblib is not None and chunk_size is None:
+        chunk_size = -(-len(pi) // joblib.effective_n_jobs(n_jobs))
+
+    if chunk_size is not None:
+        pdf = _posterior_chunked(distarray, inv_d, pi, sigma_pi, prior_d, chunk_size, fast_exp, n_jobs)
+    elif ne is not None and not fast_exp:
+        # Fused single-pass evaluation: numexpr streams through the grid
+        # blockwise instead of materialising every intermediate array
+        inv_d   = inv_d[:, np.newaxis]
+        prior_d = prior_d[:, np.newaxis]
+        inv2s2  = 0.5 / sigma_pi**2.
+        pdf     = ne.evaluate("exp(-inv2s2 * (pi - inv_d)**2) * prior_d")
     else:
-        raise ValueError("Prior keyword does not exist")
-    
-    if np.isscalar(pi):
-        return prior(distarray) * likelihood(pi, distarray, sigma_pi)
+        pdf  = _likelihood_unnormalized(pi, distarray, sigma_pi, fast_exp=fast_exp, inv_d=inv_d)
+        pdf *= prior_d[:, np.newaxis]
+    return pdf.reshape(shape)
+
+def _posterior_chunked(distarray, inv_d, pi, sigma_pi, prior_d, chunk_size, fast_exp=False, n_jobs=None):
+    """
+    Posterior distance PDF for an array of parallaxes, evaluated in chunks of 
+    stars straight into a preallocated output array (optionally in parallel threads)
+    """
+    sigma_pi = np.broadcast_to(sigma_pi, pi.shape)
+    inv_d2d  = inv_d[:, np.newaxis]
+    prior_d  = prior_d[:, np.newaxis]
+    out      = np.empty((len(distarray), len(pi)), dtype=np.result_type(pi, distarray, sigma_pi))
+
+    def evaluate_chunk(block):
+        buf   = out[:, block]
+        pi_b, sigma_b = pi[block], sigma_pi[block]
+        if ne is not None and not fast_exp:
+            ne.evaluate("exp(-inv2s2 * (pi_b - inv_d)**2) * prior_d", out=buf,
+                        local_dict=dict(inv2s2=0.5 / sigma_b**2., pi_b=pi_b, inv_d=inv_d2d, prior_d=prior_d))
+        else:
+            _likelihood_unnormalized(pi_b, distarray, sigma_b, fast_exp=fast_exp, out=buf, inv_d=inv_d)
+            buf *= prior_d
+
+    blocks = [slice(s, s + chunk_size) for s in range(0, len(pi), chunk_size)]
+    if n_jobs is not None and joblib is not None:
+        # The chunks write to disjoint columns of out, and numpy, numexpr and the
+        # numba fast exp release the GIL, so threads suffice and nothing is copied
+        joblib.Parallel(n_jobs=n_jobs, prefer="threads")(joblib.delayed(evaluate_chunk)(block) 
+                                                         for block in blocks)
     else:
-        return prior(distarray)[:, np.newaxis] * likelihood(pi, distarray, sigma_pi)
+        for block in blocks:
+            evaluate_chunk(block)
+    return out
+
+if nb is not None:
+    @nb.njit(cache=True)
+    def _kahan_add(S, c, x):
+        """
+        Compensated (Kahan) summation step: adds x to the sum S with running compensation c
+        """
+        y = x - c
+        t = S + y
+        return t, (t - S) - y
+
+    # No 'reassoc' in fastmath: it would allow the compiler to optimise the 
+    # Kahan compensation away
+    @nb.njit(fastmath={'contract', 'arcp', 'nsz'}, error_model='numpy', cache=True)
+    def _star_stats(d, inv_d, log_prior_d, pi, sigma_pi):
+        """
+        Sums of the posterior distance PDF of one star (and its first two moments),
+        accumulated over the distance grid without storing the PDF.
+        Sums are accumulated in double precision with Kahan summation, so that long 
+        (and single precision) grids do not lose accuracy.
+        """
+        # First pass in log space: maximum of the log-PDF (which also gives the mode)
+        c = -0.5 / (sigma_pi * sigma_pi)
+        lwmax, imax = -np.inf, 0
+        for i in range(d.shape[0]):
+            arg = pi - inv_d[i]
+            lw  = log_prior_d[i] + c * arg * arg
+            if lw > lwmax:
+                lwmax, imax = lw, i
+        # Second pass: PDF relative to its maximum, so that it cannot underflow as 
+        # a whole; grid points below e^-30 of the maximum are skipped without an exp
+        S, Sd, Sd2 = 0., 0., 0.
+        c_S, c_Sd, c_Sd2 = 0., 0., 0.
+        for i in range(d.shape[0]):
+            arg = pi - inv_d[i]
+            x   = log_prior_d[i] + c * arg * arg - lwmax
+            if x > -30.:
+                w  = np.float64(np.exp(x))
+                di = np.float64(d[i])
+                S,   c_S   = _kahan_add(S,   c_S,   w)
+                Sd,  c_Sd  = _kahan_add(Sd,  c_Sd,  w * di)
+                Sd2, c_Sd2 = _kahan_add(Sd2, c_Sd2, w * di * di)
+        return S, Sd, Sd2, imax
+
+    @nb.njit(parallel=True, error_model='numpy', cache=True)
+    def _stats_parallel(d, inv_d, log_prior_d, pi, sigma_pi, mean, std, mode):
+        # Stars are independent, so they are distributed over all cores
+        for k in nb.prange(pi.shape[0]):
+            S, Sd, Sd2, imax = _star_stats(d, inv_d, log_prior_d, pi[k], sigma_pi[k])
+            mean[k] = Sd / S
+            std[k]  = np.sqrt(max(Sd2 / S - mean[k] * mean[k], 0.))
+            mode[k] = d[imax]
+
+    @nb.njit(parallel=True, error_model='numpy', cache=True)
+    def _stats_parallel_grids(d, inv_d, log_prior_d, pi, sigma_pi, mean, std, mode):
+        # As _stats_parallel, but with one distance grid per star (rows of d, inv_d, log_prior_d)
+        for k in nb.prange(pi.shape[0]):
+            S, Sd, Sd2, imax = _star_stats(d[k], inv_d[k], log_prior_d[k], pi[k], sigma_pi[k])
+            mean[k] = Sd / S
+            std[k]  = np.sqrt(max(Sd2 / S - mean[k] * mean[k], 0.))
+            mode[k] = d[k, imax]
+
+    def _stats(d, inv_d, log_prior_d, pi, sigma_pi):
+        """
+        Mean, standard deviation and mode of the posterior distance PDFs
+        (scalars if pi and sigma_pi are scalar). The distance grid is either 
+        common to all stars (1D) or given per star (2D: star, distance).
+        """
+        shape        = np.broadcast(pi, sigma_pi).shape
+        pi, sigma_pi = [np.ascontiguousarray(np.broadcast_to(x, shape)).ravel() for x in (pi, sigma_pi)]
+        mean, std, mode = np.empty(pi.size), np.empty(pi.size), np.empty(pi.size)
+        driver = _stats_parallel if np.ndim(d) == 1 else _stats_parallel_grids
+        driver(d, inv_d, log_prior_d, pi, sigma_pi, mean, std, mode)
+        return mean.reshape(shape)[()], std.reshape(shape)[()], mode.reshape(shape)[()]
+else:
+    _stats = None
+
+class DistPDFEvaluator(object):
+    """
+    Reusable evaluator for posterior distance PDFs on a fixed distance grid
+    """
+    def __init__(self, min_dist=0., max_dist=30., resolution=10000, prior="exponential", 
+                 dtype=np.float64, **prior_kw):
+        """
+        Sets up the distance grid and the prior on it once, so that any number of
+        (pi, sigma_pi) sets can be evaluated against them
+            
+        Input:
+            (none)
+        Optional:
+            min_dist:  minimum allowed distance
+            max_dist:  maximum allowed distance
+            resolution:resolution of the distance PDF
+            prior:     String. Decides which prior to use (see posterior)
+            dtype:     floating point type of the distance grid and PDF (default: np.float64)
+            prior_kw:  keyword arguments of the prior function (e.g. L or rlim)
+        """
+        self.dtype = np.dtype(dtype)
+        # plain Python numbers, so that the cached grid lookup below can hash them
+        min_dist, max_dist, resolution = float(min_dist), float(max_dist), int(resolution)
+        self.min_dist, self.max_dist = min_dist, max_dist
+        self.prior = prior
+        self._step = (max_dist - min_dist) / max(resolution - 1, 1)
+        self._prior = functools.partial(_prior_function(prior), **prior_kw)
+        if prior_kw:
+            distarray    = np.linspace(min_dist, max_dist, resolution)
+            self.prior_d = _prior_function(prior)(distarray, **prior_kw).astype(self.dtype)
+            self.distarray = distarray.astype(self.dtype)
+            with np.errstate(divide="ignore"):
+                self.inv_d = np.reciprocal(self.distarray)
+        else:
+            self.distarray, self.inv_d, self.prior_d = _grid_and_prior(min_dist, max_dist, resolution, 
+                                                                       prior, self.dtype)
+        with np.errstate(divide="ignore"):
+            self.log_prior_d = np.log(self.prior_d)
+        self._buf = None
+
+    def pdf(self, pi, sigma_pi, **kwargs):
+        """
+        Normalised posterior distance PDF on distarray (1D if pi is scalar, 2D if not).
+        Further keyword arguments (chunk_size, fast_exp, n_jobs) are passed to posterior.
+        """
+        pi, sigma_pi = _as_dtype(pi, self.dtype), _as_dtype(sigma_pi, self.dtype)
+        pdf = posterior(self.distarray, pi, sigma_pi, inv_d=self.inv_d, prior_d=self.prior_d, 
+                        dtype=self.dtype, **kwargs)
+        # Stars far off the grid underflow as a whole: redo those in log space, relative 
+        # to the maximum of their PDF, consistent with the statistics from evaluate
+        pdf2d = pdf.reshape(len(self.distarray), -1)
+        finfo = np.finfo(self.dtype)
+        low   = np.flatnonzero(np.max(pdf2d, axis=0) < finfo.tiny / finfo.eps)
+        if len(low):
+            pi_l    = np.atleast_1d(pi)[low]
+            sigma_l = np.broadcast_to(sigma_pi, np.shape(np.atleast_1d(pi)))[low]
+            with np.errstate(invalid="ignore"):
+                logw  = np.subtract(pi_l, self.inv_d[:, np.newaxis])
+                logw *= logw
+                logw *= -0.5 / sigma_l**2.
+                logw += self.log_prior_d[:, np.newaxis]
+            _exp_relative_to_max(logw, 0, kwargs.get("fast_exp", False))
+            pdf2d[:, low] = logw
+        return pdf / np.sum(pdf, axis=0)
+
+    def evaluate(self, pi, sigma_pi, chunk_size=None, fast_exp=False, adaptive=False, 
+                 adaptive_resolution=200):
+        """
+        Mean, standard deviation and mode of the posterior distance PDF
+            
+        Input:
+            pi:        parallax (array or scalar)
+            sigma_pi:  parallax_uncertainty (array or scalar)
+        Optional:
+            chunk_size:number of stars evaluated at a time if numba is not installed 
+                       (default: as many as fit in a buffer of 2**20 grid points)
+            fast_exp:  use the fast approximate exponential if numba is not installed
+            adaptive:  if True, stars with a fractional parallax error below 10% get their 
+                       own grid covering pi +- 5 sigma_pi instead of the full distance grid, 
+                       if that window lies within [min_dist, max_dist]. All other stars use 
+                       the full grid, as do all stars for the uniform priors.
+            adaptive_resolution: minimum number of grid points per star for adaptive=True. 
+                       Wider windows get more points, so that the grid spacing (and thus the 
+                       resolution of the mode) is never coarser than that of the full grid.
+        Output:
+            meandist, diststd, modedist (in double precision)
+        """
+        pi, sigma_pi = _as_dtype(pi, self.dtype), _as_dtype(sigma_pi, self.dtype)
+        # The uniform priors have a hard cut at rlim, which an adaptive window may 
+        # cross, so they always use the full grid
+        if adaptive and self.prior == "exponential":
+            return self._evaluate_adaptive(pi, sigma_pi, chunk_size, fast_exp, adaptive_resolution)
+        if _stats is not None:
+            # One parallel kernel over the stars; the PDF itself is never stored
+            return _stats(self.distarray, self.inv_d, self.log_prior_d, pi, sigma_pi)
+
+        # Otherwise evaluate the log-PDF chunk by chunk in a reused buffer and derive 
+        # the statistics from it (moments as contractions over the grid axis)
+        shape    = np.shape(pi)
+        pi       = np.atleast_1d(pi)
+        sigma_pi = np.broadcast_to(sigma_pi, pi.shape)
+        R        = len(self.distarray)
+        if chunk_size is None:
+            chunk_size = max(2**20 // R, 1)
+        if self._buf is None or self._buf.shape[1] < chunk_size:
+            self._buf = np.empty((R, chunk_size), dtype=self.dtype)
+        dists = self.distarray.astype(np.float64)
+        mean, std, mode = np.empty(len(pi)), np.empty(len(pi)), np.empty(len(pi))
+        for s in range(0, len(pi), chunk_size):
+            block = slice(s, s + chunk_size)
+            buf   = self._buf[:, :len(pi[block])]
+            np.subtract(pi[block], self.inv_d[:, np.newaxis], out=buf)
+            np.square(buf, out=buf)
+            buf *= -0.5 / sigma_pi[block]**2.
+            buf += self.log_prior_d[:, np.newaxis]
+            _exp_relative_to_max(buf, 0, fast_exp)
+            mean[block], std[block], mode[block] = _weighted_stats(buf.T, dists)
+        return mean.reshape(shape)[()], std.reshape(shape)[()], mode.reshape(shape)[()]
+
+    def _evaluate_adaptive(self, pi, sigma_pi, chunk_size, fast_exp, resolution):
+        """
+        Statistics on one small distance grid per star, spanning the distances 
+        corresponding to pi +- 5 sigma_pi, where the likelihood is non-negligible
+        """
+        shape    = np.shape(pi)
+        pi       = np.atleast_1d(pi)
+        sigma_pi = np.broadcast_to(sigma_pi, pi.shape)
+        # Only for small fractional errors, where the posterior is narrow and 
+        # the prior cannot shift it outside pi +- 5 sigma_pi, and only if that window 
+        # lies within [min_dist, max_dist]: a posterior truncated by the grid edge
+        # piles up against it instead
+        precise = sigma_pi < 0.1 * pi
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lo = 1. / (pi + 5*sigma_pi)
+            hi = np.where(precise, 1. / (pi - 5*sigma_pi), np.inf)
+        ok = precise & (lo > self.min_dist) & (hi < self.max_dist)
+
+        mean, std, mode = np.empty(len(pi)), np.empty(len(pi)), np.empty(len(pi))
+        if not ok.all():
+            # Large fractional parallax errors (or windows reaching the grid edges): full grid
+            mean[~ok], std[~ok], mode[~ok] = self.evaluate(pi[~ok], sigma_pi[~ok], chunk_size, fast_exp)
+        # Stars sorted by window width, so that each chunk needs a similar number of points
+        width = hi - lo
+        idx   = np.flatnonzero(ok)
+        idx   = idx[np.argsort(width[idx])]
+        s     = 0
+        while s < len(idx):
+            chunk = chunk_size or max(2**20 // resolution, 1)
+            # Points per star: at least resolution, and no coarser than the full grid
+            n     = max(resolution, int(np.ceil(width[idx[min(s + chunk, len(idx)) - 1]] / self._step)) + 1)
+            chunk = chunk_size or max(2**20 // n, 1)
+            block = idx[s:s + chunk]
+            s    += chunk
+            t     = np.linspace(0., 1., n)
+            d     = (lo[block, np.newaxis] + width[block, np.newaxis] * t).astype(self.dtype)
+            inv_d   = np.reciprocal(d)
+            with np.errstate(divide="ignore"):
+                log_prior_d = np.log(self._prior(d)).astype(self.dtype)
+            pi_b, sigma_b = pi[block], sigma_pi[block]
+            if _stats is not None:
+                mean[block], std[block], mode[block] = _stats(d, inv_d, log_prior_d, pi_b, sigma_b)
+            else:
+                w  = inv_d - pi_b[:, np.newaxis]
+                w *= w
+                w *= -0.5 / sigma_b[:, np.newaxis]**2.
+                w += log_prior_d
+                _exp_relative_to_max(w, 1, fast_exp)
+                mean[block], std[block], mode[block] = _weighted_stats(w, d)
+        return mean.reshape(shape)[()], std.reshape(shape)[()], mode.reshape(shape)[()]
+
+def _exp_relative_to_max(logw, axis, fast_exp=False):
+    """
+    In place: exp(logw - max(logw)) along the distance axis, i.e. the PDF relative 
+    to its maximum, which (unlike exp(logw)) cannot underflow for all grid points
+    """
+    logw -= np.max(logw, axis=axis, keepdims=True)
+    if fast_exp:
+        np.negative(logw, out=logw)
+        fast_exp_neg(logw, out=logw)
+    else:
+        np.exp(logw, out=logw)
+
+def _weighted_stats(w, d):
+    """
+    Mean, standard deviation and mode of distance PDFs given (up to a factor) as 
+    weights w (star, distance) on the distance grid d (common 1D, or per star 2D)
+    """
+    d    = np.asarray(d, dtype=np.float64)
+    # A common grid stays 1D, so that no (star x distance) temporary is created for d*d
+    subs = 'ij,j->i' if d.ndim == 1 else 'ij,ij->i'
+    norm = np.sum(w, axis=1, dtype=np.float64)
+    mean = np.einsum(subs, w, d, dtype=np.float64) / norm
+    m2   = np.einsum(subs, w, d * d, dtype=np.float64) / norm
+    imax = np.argmax(w, axis=1)
+    mode = d[imax] if d.ndim == 1 else d[np.arange(len(w)), imax]
+    return mean, np.sqrt( np.maximum(m2 - mean**2., 0.) ), mode
 
 class distpdf(object):
     """
     Class for posterior distance PDF given parallax and parallax uncertainty
     """
-    def __init__(self, pi, sigma_pi, min_dist=0., max_dist=30., resolution=10000, **kwargs):
+    def __init__(self, pi, sigma_pi, min_dist=0., max_dist=30., resolution=10000, dtype=np.float64, 
+                 **kwargs):
         """
         Returns a distance array and the corresponding distance PDF
             
@@ -103,6 +586,13 @@ class distpdf(object):
             min_dist:  minimum allowed distance
             max_dist:  maximum allowed distance
             resolution:resolution of the distance PDF
+            chunk_size:number of stars for which the PDF is evaluated at a time
+                       (see posterior; default: all at once)
+            n_jobs:    number of threads for the chunked evaluation of the PDF (see posterior)
+            dtype:     floating point type of the distance grid and PDF (default: np.float64).
+                       The statistics are always returned in double precision.
+            adaptive:  compute the statistics on small per-star grids where possible
+                       (see DistPDFEvaluator.evaluate; the PDF itself uses distarray)
         Output:
             (none)
         Object properties:
@@ -111,20 +601,33 @@ class distpdf(object):
                                  2D if not)
             meandist, diststd, modedist - statistics of the distance PDF
         """
-        self.distarray = np.linspace(min_dist, max_dist, resolution)
-        distpdf   = posterior(self.distarray, pi, sigma_pi, **kwargs)
-        self.distpdf   = distpdf / np.sum(distpdf, axis=0) 
+        kwargs     = dict(kwargs)
+        prior      = kwargs.pop("prior", "exponential")
+        chunk_size = kwargs.pop("chunk_size", None)
+        fast_exp   = kwargs.pop("fast_exp", False)
+        n_jobs     = kwargs.pop("n_jobs", None)
+        adaptive   = kwargs.pop("adaptive", False)
+        if kwargs:
+            # Checked here, since the PDF (where posterior would complain) is only built on request
+            raise TypeError("distpdf got unexpected keyword argument(s): " + ", ".join(sorted(kwargs)))
+        self._evaluator = DistPDFEvaluator(min_dist, max_dist, resolution, prior=prior, dtype=dtype)
+        self.distarray  = self._evaluator.distarray
+        # Copies, so that later changes to the caller's arrays cannot make the PDF 
+        # (built on request) disagree with the statistics computed now
+        self._pi, self._sigma_pi = np.array(pi, copy=True), np.array(sigma_pi, copy=True)
+        self._kwargs    = dict(chunk_size=chunk_size, fast_exp=fast_exp, n_jobs=n_jobs)
+        self._distpdf   = None
         
         # Compute some basic statistics: Mean, standard deviation, and mode 
-        if np.isscalar(pi):
-            self.meandist = np.average( self.distarray, axis=0, weights=self.distpdf )
-            self.diststd  = np.sqrt( np.average( (self.distarray - self.meandist)**2, 
-                                                  axis=0, weights=self.distpdf ) )
-            self.modedist = self.distarray[np.argmax(self.distpdf)]
-        else:
-            self.meandist = np.sum(self.distpdf*self.distarray[:, np.newaxis]/np.sum(self.distpdf,axis=0), axis=0)
-            self.diststd  = np.sqrt( np.sum( self.distpdf * 
-                                            (self.distarray[:, np.newaxis] - self.meandist[np.newaxis,:] / np.sum(self.distpdf,axis=0) )**2., axis=0 ))
-            self.modedist = self.distarray[np.argmax(self.distpdf, axis=0)]
-
+        # (the PDF itself is only built on request)
+        self.meandist, self.diststd, self.modedist = self._evaluator.evaluate(
+            pi, sigma_pi, chunk_size=chunk_size, fast_exp=fast_exp, adaptive=adaptive)
 
+    @property
+    def distpdf(self):
+        """
+        Normalised posterior distance PDF on distarray (computed on first access)
+        """
+        if self._distpdf is None:
+            self._distpdf = self._evaluator.pdf(self._pi, self._sigma_pi, **self._kwargs)
+        return self._distpdf